@@ -1,9 +1,19 @@
-import pandas as pd
-import requests
-from datetime import datetime, timedelta
+import csv
+import operator
+import sys
+from datetime import datetime
+from typing import Any
+
+import msgspec
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from moa_common import to_roc, build_roc_map, period_windows, create_session, cache_expiry
 
 # === 1️ API 網址 ===
 url = "https://data.moa.gov.tw/Service/OpenData/FromM/FarmTransData.aspx"
+MAX_WORKERS = 10   # 多執行緒數量
+SEGMENT_DAYS = 10  # 每段區間天數
+session = create_session(MAX_WORKERS)
 
 # === 2️ 中英欄位對照表 ===
 column_map = {
@@ -32,29 +42,66 @@ code_to_name = {
     "X69": "釋迦", "31": "番茄枝"
 }
 
-# === 4️ 抓取資料函式 ===
+# === 4️ 民國 → 西元日期轉換 ===
+def roc_to_ad(date_str):
+    """將民國日期轉西元 (例：1090101 → 2020-01-01)"""
+    if date_str is None:
+        return None
+    date_str = str(date_str).replace(".", "").replace("/", "")
+    if len(date_str) != 7:
+        return None
+    try:
+        y = int(date_str[:3]) + 1911
+        m = int(date_str[3:5])
+        d = int(date_str[5:7])
+        return f"{y:04d}-{m:02d}-{d:02d}"
+    except:
+        return None
+
+# === 5️ 輸出欄位（依序對應 API 中文欄位）===
+OUTPUT_COLUMNS = [
+    "TransDate", "TypeCode", "CropCode", "CropName", "MarketCode", "MarketName",
+    "UpperPrice", "MiddlePrice", "LowerPrice", "AveragePrice", "TransVolume"
+]
+
+# API 回傳的一筆交易資料：中文欄位直接解碼成英文屬性，不建立 dict
+FarmTrans = msgspec.defstruct(
+    "FarmTrans",
+    [(eng, Any, msgspec.field(default=None, name=zh)) for zh, eng in column_map.items()]
+)
+farm_trans_decoder = msgspec.json.Decoder(list[FarmTrans])
+get_output_values = operator.attrgetter(*OUTPUT_COLUMNS)
+
+def to_row(rec):
+    """將一筆 API 資料轉成輸出用 tuple（日期轉西元、作物名稱換成 FinalName）"""
+    row = list(get_output_values(rec))
+    row[0] = roc_ad_map.get(row[0]) or roc_to_ad(row[0])
+    row[3] = code_to_name.get(row[2], row[3])  # 對照表沒有時保留 API 原本的作物名稱
+    return tuple(row)
+
+# === 6️ 抓取資料函式 ===
 def fetch_data(start, end, page_top=2000):
-    """抓取 N05 水果資料（只保留指定作物代號）"""
+    """抓取 N05 水果資料（只保留指定作物代號），回傳輸出用 tuple"""
     all_data = []
     valid_codes = set(code_to_name.keys())
 
     params = {
-        "StartDate": f"{start.year - 1911:03d}.{start.month:02d}.{start.day:02d}",
-        "EndDate": f"{end.year - 1911:03d}.{end.month:02d}.{end.day:02d}",
+        "StartDate": to_roc(start),
+        "EndDate": to_roc(end),
         "TcType": "N05",  # 水果
         "$top": page_top,
         "$skip": 0
     }
 
     while True:
-        r = requests.get(url, params=params, timeout=30)
+        r = session.get(url, params=params, timeout=30, expire_after=cache_expiry(end))
         r.raise_for_status()
-        data = r.json()
+        data = farm_trans_decoder.decode(r.content)
         if not data:
             break
 
         # 篩選出指定作物代號
-        filtered = [item for item in data if item.get("作物代號") in valid_codes]
+        filtered = [to_row(rec) for rec in data if rec.CropCode in valid_codes]
         all_data.extend(filtered)
 
         if len(data) < page_top:
@@ -65,55 +112,42 @@ def fetch_data(start, end, page_top=2000):
     return all_data
 
 
-# === 5️ 設定抓取期間 ===
+# === 7️ 設定抓取期間 ===
 start_date = datetime(2020, 1, 1)
 end_date = datetime(2025, 10, 29)
-
-# === 6️ 一天一天抓取 ===
-all_records = []
-cursor = start_date
-
-while cursor <= end_date:
-    print(f"抓取日期：{cursor.date()}")
-    data = fetch_data(cursor, cursor)  # 每天抓一天
-    if data:
-        all_records.extend(data)
-    cursor += timedelta(days=1)
-
-print(f"\n 資料抓取完成，共 {len(all_records)} 筆")
-
-# === 7️ 建立 DataFrame ===
-df = pd.DataFrame(all_records)
-
-# === 8️ 欄位轉英文 ===
-df = df.rename(columns={col: column_map.get(col, col) for col in df.columns})
-
-# === 9️ 民國 → 西元日期轉換 ===
-def roc_to_ad(date_str):
-    """將民國日期轉西元 (例：1090101 → 2020-01-01)"""
-    if pd.isna(date_str):
-        return None
-    date_str = str(date_str).replace(".", "").replace("/", "")
-    if len(date_str) != 7:
-        return None
-    try:
-        y = int(date_str[:3]) + 1911
-        m = int(date_str[3:5])
-        d = int(date_str[5:7])
-        return f"{y:04d}-{m:02d}-{d:02d}"
-    except:
-        return None
-
-if "TransDate" in df.columns:
-    df["TransDate"] = df["TransDate"].apply(roc_to_ad)
-    df["TransDate"] = pd.to_datetime(df["TransDate"], errors="coerce")
-
-# === 10 替換作物名稱 ===
-df["CropName"] = df["CropCode"].map(code_to_name)
-
-# === 11 輸出結果 ===
+roc_ad_map = build_roc_map(start_date, end_date, sep="-")  # 109.01.01 → 2020-01-01，查不到再走 roc_to_ad
 output_file = "moa_N05_35fruit.csv"
-df.to_csv(output_file, index=False, encoding="utf-8-sig")
 
-print(f"\n🎉 全部完成！共 {len(df)} 筆資料（35 種水果）")
+# === 8️ 每 10 天一段，多執行緒抓取，邊抓邊寫入 CSV ===
+total_cnt = 0
+failed_periods = []
+period_list = list(period_windows(start_date, end_date, days=SEGMENT_DAYS))
+
+with open(output_file, "w", newline="", encoding="utf-8-sig", buffering=1 << 20) as f:
+    writer = csv.writer(f)
+    writer.writerow(OUTPUT_COLUMNS)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(fetch_data, p_start, p_end): (p_start, p_end)
+                   for p_start, p_end in period_list}
+        for future in as_completed(futures):
+            p_start, p_end = futures[future]
+            try:
+                rows = future.result()
+            except Exception as e:
+                print(f"❌ {p_start.date()} ~ {p_end.date()} 抓取失敗：{e}")
+                failed_periods.append((p_start, p_end))
+                continue
+            print(f"抓取期間：{p_start.date()} ~ {p_end.date()}，共 {len(rows)} 筆")
+            writer.writerows(rows)
+            total_cnt += len(rows)
+
+# 有任何區間失敗時，列出缺漏區間並以非 0 結束，避免誤用不完整的 CSV
+if failed_periods:
+    print(f"\n❌ 共 {len(failed_periods)} 段抓取失敗，{output_file} 資料不完整：")
+    for p_start, p_end in sorted(failed_periods):
+        print(f"   - {p_start.date()} ~ {p_end.date()}")
+    sys.exit(1)
+
+print(f"\n🎉 全部完成！共 {total_cnt} 筆資料（35 種水果）")
 print(f"💾 已輸出檔案：{output_file}")
@@ -1,11 +1,14 @@
-import requests
-import time
+import orjson
 import datetime as dt
 from dateutil.relativedelta import relativedelta
 import csv
-import urllib3
+import itertools
+import os
+import shutil
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Lock
+
+from moa_common import to_roc, roc_to_western, build_roc_map, period_windows, create_session, cache_expiry
 
 # -----------------------------
 # 設定
@@ -18,69 +21,44 @@ USE_ROC = True        # 查詢時使用民國年格式
 MAX_WORKERS = 10      # 多執行緒數量
 SEGMENT_DAYS = 10     # 每段區間天數
 RETRY_DELAY_BASE = 1  # 失敗重試延遲基礎秒數
+PAGE_PREFETCH = 4     # 第一頁滿頁時，同時預抓的後續頁數
+MAX_CONCURRENT_REQUESTS = MAX_WORKERS  # 同時送出的 API 請求上限（若常遇到 429 可再調低）
 
 # ✅ 設定時間範圍：2020/1/1 ~ 2025/10/19
 start_date = dt.date(2020, 1, 1)
 end_date   = dt.date(2025, 10, 19)
 
 # -----------------------------
-# SSL 完整繞過設定
-# -----------------------------
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-session = requests.Session()
-session.verify = False
-
-# -----------------------------
-# 民國 ↔ 西元日期處理
+# SSL 完整繞過 + 連線池設定
 # -----------------------------
-def to_roc(date_obj: dt.date, use_roc=True) -> str:
-    if use_roc:
-        year = date_obj.year - 1911
-    else:
-        year = date_obj.year
-    return f"{year:03d}.{date_obj.month:02d}.{date_obj.day:02d}"
+session = create_session(MAX_WORKERS, RETRY_DELAY_BASE, verify=False)
 
-def roc_to_western(date_str: str) -> str:
-    if not date_str:
-        return ""
-    try:
-        parts = date_str.split(".")
-        if len(parts) != 3:
-            return date_str
-        roc_year = int(parts[0])
-        western_year = roc_year + 1911
-        return f"{western_year:04d}.{int(parts[1]):02d}.{int(parts[2]):02d}"
-    except Exception:
-        return date_str
+# 抓取期間內的「民國日期 → 西元日期」對照表
+roc_map = build_roc_map(start_date, end_date)
 
 print("📅 抓取期間：", start_date, "~", end_date)
 print("目前使用查詢格式：", "民國" if USE_ROC else "西元")
 
 # -----------------------------
-# 分段時間產生器（10天為一批）
+# JSON 請求函式（重試由 session 的 Retry 設定處理，expire_after 控制快取期限）
 # -----------------------------
-def period_windows(start_d: dt.date, end_d: dt.date, days=SEGMENT_DAYS):
-    cursor = start_d
-    while cursor <= end_d:
-        period_start = cursor
-        period_end = min(end_d, cursor + dt.timedelta(days=days - 1))
-        yield period_start, period_end
-        cursor = period_end + dt.timedelta(days=1)
+request_slots = threading.Semaphore(MAX_CONCURRENT_REQUESTS)
+encoding_checked = False
 
-# -----------------------------
-# JSON 請求函式（含重試與延遲）
-# -----------------------------
-def get_json(url, params=None, max_retry=5, timeout=40):
-    for i in range(max_retry):
-        try:
-            r = session.get(url, params=params, timeout=timeout)
-            r.raise_for_status()
-            return r.json()
-        except Exception as e:
-            print(f"⚠️ 第 {i+1} 次連線失敗：{e}")
-            time.sleep(RETRY_DELAY_BASE * (i + 1))
-    print("❌ 超過最大重試次數，放棄此次請求。")
-    return []
+def get_json(url, params=None, timeout=40, expire_after=dt.timedelta(days=1)):
+    global encoding_checked
+    try:
+        with request_slots:
+            r = session.get(url, params=params, timeout=timeout, expire_after=expire_after)
+        r.raise_for_status()
+        # 只在實際向伺服器取得的交易資料回應上確認壓縮格式（快取命中沒有傳輸）
+        if not encoding_checked and url == FARM_TRANS_URL and not getattr(r, "from_cache", False):
+            encoding_checked = True
+            print(f"📦 回應壓縮格式：{r.headers.get('Content-Encoding', '未壓縮')}")
+        return orjson.loads(r.content)
+    except Exception as e:
+        print(f"❌ 超過最大重試次數，放棄此次請求：{e}")
+        return []
 
 # -----------------------------
 # 抓作物代碼表
@@ -119,96 +97,131 @@ print(f"前幾個蔬果名稱預覽：{list(code_to_name.values())[:10]}")
 # -----------------------------
 # 資料正規化
 # -----------------------------
-OUTPUT_FIELDS = [
-    "TransDate", "MarketCode", "MarketName", "CropCode", "CropName",
-    "CategoryCode", "UpperPrice", "MiddlePrice", "LowerPrice",
-    "AveragePrice", "TransVolume", "TransAmount", "Unit",
-    "County", "Township", "UpdateTime"
+# 輸出欄位 → 候選來源欄位（依序取第一個非空值）
+FIELD_MAP = [
+    ("TransDate", "TransDate", "交易日期"),
+    ("MarketCode", "MarketCode", "市場代號"),
+    ("MarketName", "MarketName", "市場名稱"),
+    ("CropCode", "CropCode", "作物代號"),
+    ("CropName", "CropName", "作物名稱"),
+    ("CategoryCode", "CategoryCode", "種類代碼", "TypeCode"),
+    ("UpperPrice", "UpperPrice", "上價"),
+    ("MiddlePrice", "MiddlePrice", "中價", "平均價"),
+    ("LowerPrice", "LowerPrice", "下價"),
+    ("AveragePrice", "AveragePrice", "平均價", "中價"),
+    ("TransVolume", "TransVolume", "交易量"),
+    ("TransAmount", "TransAmount", "交易金額"),
+    ("Unit", "Unit", "單位"),
+    ("County", "County", "縣市"),
+    ("Township", "Township", "鄉鎮"),
+    ("UpdateTime", "UpdateTime", "更新時間"),
 ]
-
-def normalize_record(rec: dict) -> dict:
-    def pick(*candidates):
+OUTPUT_FIELDS = [field for field, *_ in FIELD_MAP]
+FIELD_CANDIDATES = [tuple(candidates) for _, *candidates in FIELD_MAP]
+
+def normalize_record(rec: dict) -> tuple:
+    """依 OUTPUT_FIELDS 順序回傳 tuple，直接交給 csv.writer"""
+    row = []
+    for candidates in FIELD_CANDIDATES:
+        value = ""
         for c in candidates:
-            if c in rec and rec[c] not in (None, ""):
-                return rec[c]
-        return ""
-    d = {
-        "TransDate": pick("TransDate", "交易日期"),
-        "MarketCode": pick("MarketCode", "市場代號"),
-        "MarketName": pick("MarketName", "市場名稱"),
-        "CropCode": pick("CropCode", "作物代號"),
-        "CropName": pick("CropName", "作物名稱"),
-        "CategoryCode": pick("CategoryCode", "種類代碼", "TypeCode"),
-        "UpperPrice": pick("UpperPrice", "上價"),
-        "MiddlePrice": pick("MiddlePrice", "中價", "平均價"),
-        "LowerPrice": pick("LowerPrice", "下價"),
-        "AveragePrice": pick("AveragePrice", "平均價", "中價"),
-        "TransVolume": pick("TransVolume", "交易量"),
-        "TransAmount": pick("TransAmount", "交易金額"),
-        "Unit": pick("Unit", "單位"),
-        "County": pick("County", "縣市"),
-        "Township": pick("Township", "鄉鎮"),
-        "UpdateTime": pick("UpdateTime", "更新時間")
-    }
-    d["TransDate"] = roc_to_western(d["TransDate"])
-    return d
+            v = rec.get(c)
+            if v is not None and v != "":
+                value = v
+                break
+        row.append(value)
+    row[0] = roc_map.get(row[0]) or roc_to_western(row[0])  # TransDate
+    return tuple(row)
 
 # -----------------------------
 # 單段抓取函式（僅 N05）
 # -----------------------------
+def get_category_code(rec: dict) -> str:
+    return str(rec.get("CategoryCode", rec.get("種類代碼", ""))).strip()
+
+# 分頁預抓使用獨立的執行緒池，避免與期間任務互相佔用
+page_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
 def fetch_period_block(period_start: dt.date, period_end: dt.date, page_top=2000):
     all_rows = []
-    skip = 0
     print(f"🔍 抓取期間：{period_start} ~ {period_end} ({to_roc(period_start)} ~ {to_roc(period_end)})")
 
-    while True:
+    def fetch_page(skip):
         params = {
             "StartDate": to_roc(period_start, USE_ROC),
             "EndDate": to_roc(period_end, USE_ROC),
+            "TcType": "N05",  # ✅ 由伺服器端只回傳 N05
             "$top": page_top,
             "$skip": skip
         }
-        data = get_json(FARM_TRANS_URL, params=params)
-        if not isinstance(data, list) or not data:
-            break
-
-        matched = 0
-        for rec in data:
-            category_code = str(rec.get("CategoryCode", rec.get("種類代碼", ""))).strip()
-            if category_code == "N05":  # ✅ 只抓 N05
-                all_rows.append(normalize_record(rec))
-                matched += 1
-
-        print(f"✅ {period_start}~{period_end} 共 {len(data)} 筆，其中符合 {matched} 筆。")
-        if len(data) < page_top:
-            break
-        skip += page_top
+        return get_json(FARM_TRANS_URL, params=params, expire_after=cache_expiry(period_end))
+
+    # 先抓第一頁；若滿頁，再一次並行預抓 PAGE_PREFETCH 頁，直到出現不滿頁為止
+    pages = [fetch_page(0)]
+    skip = page_top
+    while pages:
+        for data in pages:
+            if not isinstance(data, list) or not data:
+                return all_rows
+
+            # 伺服器端已用 TcType 篩選，只在每頁第一筆做一次檢查；異常時才逐筆過濾
+            if get_category_code(data[0]) == "N05":
+                all_rows.extend(map(normalize_record, data))
+            else:
+                print(f"⚠️ {period_start}~{period_end} 伺服器端篩選失效，改為逐筆過濾 N05")
+                all_rows.extend(normalize_record(rec) for rec in data if get_category_code(rec) == "N05")
+
+            print(f"✅ {period_start}~{period_end} 共 {len(data)} 筆。")
+            if len(data) < page_top:
+                return all_rows
+
+        skips = range(skip, skip + PAGE_PREFETCH * page_top, page_top)
+        pages = list(page_executor.map(fetch_page, skips))
+        skip += PAGE_PREFETCH * page_top
 
     return all_rows
 
 # -----------------------------
 # 多執行緒處理 + 進度顯示
 # -----------------------------
-progress_lock = Lock()
-completed_tasks = 0
+progress = itertools.count(1)  # next() 在 CPython 下為原子操作，不需額外加鎖
+PROGRESS_EVERY = 10            # 每完成幾段才輸出一次進度
+
+# 每個執行緒各寫一個分片檔，寫入時完全不需加鎖；結束後再依序合併
+shard_local = threading.local()
+shard_files = []
+
+def get_shard_writer():
+    if not hasattr(shard_local, "writer"):
+        shard_path = f"{OUTPUT_CSV}.{threading.get_ident()}.part"
+        f = open(shard_path, "w", newline="", encoding="utf-8", buffering=1 << 20)
+        shard_files.append(f)  # list.append 為原子操作
+        shard_local.writer = csv.writer(f)
+    return shard_local.writer
+
+def merge_shards():
+    with open(OUTPUT_CSV, "w", newline="", encoding="utf-8-sig") as out:
+        csv.writer(out).writerow(OUTPUT_FIELDS)
+        out.flush()
+        for f in shard_files:
+            f.close()
+            with open(f.name, "rb") as part:
+                shutil.copyfileobj(part, out.buffer)
+            os.remove(f.name)
 
 def process_period(p_start, p_end, total_tasks):
-    global completed_tasks
     rows = fetch_period_block(p_start, p_end)
     if rows:
-        with open(OUTPUT_CSV, "a", newline="", encoding="utf-8-sig") as f:
-            writer = csv.DictWriter(f, fieldnames=OUTPUT_FIELDS)
-            for r in rows:
-                writer.writerow(r)
+        get_shard_writer().writerows(rows)
         print(f"[{p_start} ~ {p_end}] ✅ 寫入 {len(rows)} 筆")
     else:
         print(f"[{p_start} ~ {p_end}] ⚠️ 無資料")
 
     # 更新進度
-    with progress_lock:
-        completed_tasks += 1
-        percent = completed_tasks / total_tasks * 100
-        print(f"📊 進度：{completed_tasks}/{total_tasks} ({percent:.1f}%)")
+    done = next(progress)
+    if done % PROGRESS_EVERY == 0 or done == total_tasks:
+        percent = done / total_tasks * 100
+        print(f"📊 進度：{done}/{total_tasks} ({percent:.1f}%)")
 
     return len(rows)
 
@@ -218,11 +231,6 @@ def process_period(p_start, p_end, total_tasks):
 period_list = list(period_windows(start_date, end_date, days=SEGMENT_DAYS))
 total_tasks = len(period_list)
 
-# 寫入 CSV 標頭
-with open(OUTPUT_CSV, "w", newline="", encoding="utf-8-sig") as f:
-    writer = csv.DictWriter(f, fieldnames=OUTPUT_FIELDS)
-    writer.writeheader()
-
 total_cnt = 0
 with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
     futures = {executor.submit(process_period, p_start, p_end, total_tasks): (p_start, p_end)
@@ -232,5 +240,9 @@ with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
             total_cnt += future.result()
         except Exception as e:
             print(f"❌ 子執行緒錯誤：{e}")
+page_executor.shutdown()
+
+# 合併各執行緒的分片檔並寫入 CSV 標頭
+merge_shards()
 
 print(f"\n🎉 完成！總筆數：{total_cnt}，輸出檔：{OUTPUT_CSV}")
@@ -0,0 +1,119 @@
+"""
+農業部 (MoA) 開放資料爬蟲共用工具
+- 民國 ↔ 西元日期轉換
+- 分段時間產生器
+- 已設定連線池、重試與本機快取的 requests session（可選擇略過 SSL 驗證）
+"""
+
+import datetime as dt
+import functools
+
+import requests_cache
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+SEGMENT_DAYS = 10      # 預設每段區間天數
+CACHE_NAME = "moa_cache"  # 回應快取 (SQLite) 檔名
+RECENT_DAYS = 30       # 最近幾天內的資料可能仍會更新，只短暫快取
+
+
+# -----------------------------
+# 民國 ↔ 西元日期處理
+# -----------------------------
+@functools.lru_cache(maxsize=None)
+def to_roc(date_obj: dt.date, use_roc=True) -> str:
+    if use_roc:
+        year = date_obj.year - 1911
+    else:
+        year = date_obj.year
+    return f"{year:03d}.{date_obj.month:02d}.{date_obj.day:02d}"
+
+
+def roc_to_western(date_str: str) -> str:
+    if not date_str:
+        return ""
+    try:
+        parts = date_str.split(".")
+        if len(parts) != 3:
+            return date_str
+        roc_year = int(parts[0])
+        western_year = roc_year + 1911
+        return f"{western_year:04d}.{int(parts[1]):02d}.{int(parts[2]):02d}"
+    except Exception:
+        return date_str
+
+
+def build_roc_map(start_d: dt.date, end_d: dt.date, sep=".") -> dict:
+    """預先建立區間內所有「民國日期 → 西元日期」對照表，逐筆轉換時只需查表
+
+    key 為 API 回傳的民國格式 (例：109.01.01)，value 以 sep 分隔 (例：2020.01.01)
+    """
+    roc_map = {}
+    d = start_d
+    while d <= end_d:
+        roc_map[f"{d.year - 1911:03d}.{d.month:02d}.{d.day:02d}"] = f"{d.year:04d}{sep}{d.month:02d}{sep}{d.day:02d}"
+        d += dt.timedelta(days=1)
+    return roc_map
+
+
+# -----------------------------
+# 分段時間產生器（預設 10 天為一批）
+# -----------------------------
+def period_windows(start_d: dt.date, end_d: dt.date, days=SEGMENT_DAYS):
+    cursor = start_d
+    while cursor <= end_d:
+        period_start = cursor
+        period_end = min(end_d, cursor + dt.timedelta(days=days - 1))
+        yield period_start, period_end
+        cursor = period_end + dt.timedelta(days=1)
+
+
+# -----------------------------
+# 連線池 + 快取 session（verify=False 時完整繞過 SSL）
+# -----------------------------
+def create_session(max_workers=10, retry_delay_base=1, cache_name=CACHE_NAME, verify=True):
+    """連線池大小配合執行緒數量，重試交給 urllib3 處理（指數退避）
+
+    GET 回應存在本機 SQLite 快取，重跑時歷史區間不必重新下載
+    預設驗證 SSL 憑證；只有明確傳入 verify=False 時才略過驗證並關閉相關警告
+    """
+    if not verify:
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    session = requests_cache.CachedSession(
+        cache_name,
+        backend="sqlite",
+        expire_after=requests_cache.NEVER_EXPIRE,
+        allowable_methods=("GET",)
+    )
+    session.verify = verify
+    # Accept-Encoding 沿用 requests 預設（gzip/deflate，若有安裝 br/zstd 也會一併宣告）
+    session.headers.update({
+        "User-Agent": "Mozilla/5.0"
+    })
+
+    # 429/503 時依伺服器的 Retry-After 等待；退避時間加上隨機抖動，避免各執行緒同時重試
+    retry_strategy = Retry(
+        total=5,
+        backoff_factor=retry_delay_base,
+        backoff_jitter=0.5,
+        respect_retry_after_header=True,
+        status_forcelist=[429, 500, 502, 503, 504]
+    )
+    adapter = HTTPAdapter(
+        pool_connections=max_workers,
+        pool_maxsize=max_workers * 2,  # 期間任務 + 分頁預抓
+        max_retries=retry_strategy
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def cache_expiry(period_end: dt.date):
+    """歷史資料不會變動，永久快取；最近 RECENT_DAYS 天內的區間只快取 1 天"""
+    if isinstance(period_end, dt.datetime):
+        period_end = period_end.date()
+    if period_end >= dt.date.today() - dt.timedelta(days=RECENT_DAYS):
+        return dt.timedelta(days=1)
+    return requests_cache.NEVER_EXPIRE
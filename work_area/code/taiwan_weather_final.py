@@ -6,15 +6,20 @@
 輸出逐時 (hourly) 和每日 (daily) 兩種格式
 """
 
+import numpy as np
 import pandas as pd
+import polars as pl
 from datetime import datetime, timedelta
 import requests
 import json
+import orjson
 import warnings
 from urllib3.exceptions import InsecureRequestWarning
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 import os
 
 warnings.filterwarnings("ignore", category=InsecureRequestWarning)
@@ -27,6 +32,9 @@ END_DATE = datetime(2025, 10, 22)
 OUTPUT_DIR = "codis_data"
 OUTPUT_CSV_HOURLY = "taiwan_weather_hourly.csv"  # 逐時資料
 OUTPUT_CSV_DAILY = "taiwan_weather_daily.csv"    # 每日資料
+MAX_WORKERS = 12  # 同時下載的執行緒數量
+CACHE_DIR = os.path.join(OUTPUT_DIR, "cache")  # 每測站每日 API 原始回應的 JSON 快取
+WRITE_CSV = True  # 除 Parquet 外是否同時輸出 CSV（相容舊流程）
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
@@ -65,6 +73,8 @@ class TyphoonWarningFetcher:
     def __init__(self):
         self.typhoon_api_url = "https://rdc28.cwa.gov.tw/TDB/public/warning_typhoon_list/get_warning_typhoon"
         self.typhoon_main_url = "https://rdc28.cwa.gov.tw/TDB/public/warning_typhoon_list/"
+        # 各年份共用同一個 session，重複使用連線池
+        self.session = self.create_scraper_session()
     
     def create_scraper_session(self):
         session = requests.Session()
@@ -78,20 +88,21 @@ class TyphoonWarningFetcher:
     def fetch_typhoon_warnings_for_year(self, year):
         """擷取指定年份的颱風警報資料"""
         print(f"[颱風警報] 查詢 {year} 年資料...")
-        session = self.create_scraper_session()
+        session = self.session
         try:
             response = session.get(self.typhoon_main_url, timeout=30, verify=False)
             if response.status_code != 200:
                 return []
             
             post_data = {"year": str(year)}
-            session.headers.update({
+            # 標頭只套用在此次請求，避免多執行緒同時修改共用 session
+            post_headers = {
                 "Referer": self.typhoon_main_url,
                 "X-Requested-With": "XMLHttpRequest",
                 "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
-            })
+            }
             
-            response = session.post(self.typhoon_api_url, data=post_data, timeout=30, verify=False)
+            response = session.post(self.typhoon_api_url, data=post_data, headers=post_headers, timeout=30, verify=False)
             if response.status_code == 200:
                 response_text = response.text.strip()
                 if response_text.startswith("\ufeff"):
@@ -136,9 +147,11 @@ class TyphoonWarningFetcher:
     def fetch_all_warnings(self, start_year, end_year):
         """擷取指定年份範圍內的所有颱風警報"""
         all_warnings = []
-        for year in range(start_year, end_year + 1):
-            warnings = self.fetch_typhoon_warnings_for_year(year)
-            all_warnings.extend(warnings)
+        years = range(start_year, end_year + 1)
+        # 各年份同時查詢
+        with ThreadPoolExecutor(max_workers=len(years)) as executor:
+            for warnings in executor.map(self.fetch_typhoon_warnings_for_year, years):
+                all_warnings.extend(warnings)
         date_warnings = self.parse_typhoon_data_to_dates(all_warnings)
         print(f"[颱風警報] 總計找到 {len(date_warnings)} 個有颱風警報的日期\n")
         return date_warnings
@@ -151,7 +164,17 @@ class CODiSAPICrawler:
     
     def __init__(self):
         self.api_url = "https://codis.cwa.gov.tw/api/station"
-        self.session = requests.Session()
+        # 每個執行緒各自持有一個 session，可安全地多執行緒同時爬取
+        self._local = threading.local()
+    
+    @property
+    def session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = self.create_session()
+        return self._local.session
+    
+    def create_session(self):
+        session = requests.Session()
         
         # 設定重試策略
         retry_strategy = Retry(
@@ -160,17 +183,18 @@ class CODiSAPICrawler:
             status_forcelist=[429, 500, 502, 503, 504]
         )
         adapter = HTTPAdapter(max_retries=retry_strategy)
-        self.session.mount("http://", adapter)
-        self.session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
         
         # 設定 Headers
-        self.session.headers.update({
+        session.headers.update({
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
             "Accept": "application/json, text/plain, */*",
             "Accept-Language": "zh-TW,zh;q=0.9,en;q=0.8",
             "Referer": "https://codis.cwa.gov.tw/StationData",
             "Origin": "https://codis.cwa.gov.tw"
         })
+        return session
     
     def get_station_type(self, station_id):
         """根據測站代號判斷類型"""
@@ -184,45 +208,26 @@ class CODiSAPICrawler:
         else:
             return "agr"  # 農業站
     
-    def parse_hourly_data(self, data_dict):
-        """解析逐時資料"""
-        parsed = {}
-        for key, value in data_dict.items():
-            if key == 'DataTime':
-                parsed['DataTime'] = value
-                continue
-            
-            # 處理巢狀結構 (例如: {'Instantaneous': 999.8})
-            if isinstance(value, dict):
-                # 取第一個值（通常是 Instantaneous）
-                if value:
-                    first_key = list(value.keys())[0]
-                    raw_value = value[first_key]
-                    
-                    # 處理特殊代碼：負值通常代表無效資料
-                    if raw_value is not None and isinstance(raw_value, (int, float)):
-                        if raw_value < 0:
-                            parsed[key] = None  # 將負值轉為 None (空值)
-                        else:
-                            parsed[key] = raw_value
-                    else:
-                        parsed[key] = raw_value
-                else:
-                    parsed[key] = None
-            else:
-                # 處理非巢狀結構的特殊代碼
-                if value is not None and isinstance(value, (int, float)):
-                    if value < 0:
-                        parsed[key] = None
-                    else:
-                        parsed[key] = value
-                else:
-                    parsed[key] = value
+    def parse_hourly_data(self, hourly_data):
+        """解析逐時資料（一天只有 24 筆，逐筆處理比整批 json_normalize 更快）"""
+        records = []
+        for data_dict in hourly_data:
+            parsed = {}
+            for key, value in data_dict.items():
+                # 處理巢狀結構 (例如: {'Instantaneous': 999.8})，只取第一個值（通常是 Instantaneous）
+                if isinstance(value, dict):
+                    value = next(iter(value.values()), None)
+                
+                # 處理特殊代碼：負值通常代表無效資料
+                if isinstance(value, (int, float)) and value < 0:
+                    value = None
+                parsed[key] = value
+            records.append(parsed)
         
-        return parsed
+        return pd.DataFrame(records)
     
-    def fetch_weather_data(self, station_id, target_date):
-        """獲取指定測站的指定日期資料"""
+    def fetch_hourly_payload(self, station_id, target_date):
+        """獲取指定測站的指定日期原始逐時資料（API 回傳的 dts 清單）"""
         
         # 準備 API 參數
         date_str = target_date.strftime("%Y-%m-%d")
@@ -251,7 +256,7 @@ class CODiSAPICrawler:
             response = self.session.post(self.api_url, data=data, verify=False, timeout=30)
             
             if response.status_code == 200:
-                result = response.json()
+                result = orjson.loads(response.content)
                 
                 # 檢查回應結構
                 if 'code' in result and result['code'] != 200:
@@ -262,19 +267,7 @@ class CODiSAPICrawler:
                     # 使用正確的 key: 'dts'
                     hourly_data = result['data'][0].get('dts', [])
                     
-                    if not hourly_data:
-                        return None
-                    
-                    # 解析每小時資料
-                    parsed_records = []
-                    for hour_dict in hourly_data:
-                        parsed_record = self.parse_hourly_data(hour_dict)
-                        parsed_records.append(parsed_record)
-                    
-                    # 轉換為 DataFrame
-                    df = pd.DataFrame(parsed_records)
-                    
-                    return df
+                    return hourly_data or None
                 else:
                     return None
             else:
@@ -282,6 +275,51 @@ class CODiSAPICrawler:
                 
         except Exception as e:
             return None
+    
+    def fetch_weather_data(self, station_id, target_date):
+        """獲取指定測站的指定日期資料，解析為 DataFrame"""
+        hourly_data = self.fetch_hourly_payload(station_id, target_date)
+        if hourly_data is None:
+            return None
+        return self.parse_hourly_data(hourly_data)
+
+# =============================
+# 本機快取（歷史資料不會變動，重跑時不必重新下載）
+# 快取 API 原始回應而非解析後的結果，修改解析邏輯後重跑仍會套用新的解析方式
+# =============================
+def cache_path(station_id, target_date):
+    """快取檔路徑：CACHE_DIR/{station_id}/{yyyy}/{yyyymmdd}.json"""
+    return os.path.join(CACHE_DIR, station_id, target_date.strftime("%Y"), target_date.strftime("%Y%m%d") + ".json")
+
+def fetch_weather_data_cached(crawler, station_id, target_date):
+    """先讀快取，沒有才呼叫 API；只快取已結束日期的成功結果"""
+    path = cache_path(station_id, target_date)
+    hourly_data = None
+    if os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                hourly_data = orjson.loads(f.read())
+        except Exception:
+            # 快取檔損毀（例如上次寫入途中被中斷），改為重新下載並覆蓋
+            hourly_data = None
+    
+    if hourly_data is None:
+        hourly_data = crawler.fetch_hourly_payload(station_id, target_date)
+        if hourly_data is None:
+            return None
+        if target_date.date() < datetime.now().date():
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # 先寫暫存檔再改名，中斷時不會留下寫到一半的快取檔
+                tmp_path = path + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(orjson.dumps(hourly_data))
+                os.replace(tmp_path, path)
+            except Exception as e:
+                # 快取寫入失敗不影響本次結果，只是下次需重新下載
+                print(f"⚠️ 快取寫入失敗 {path}：{e}")
+    
+    return crawler.parse_hourly_data(hourly_data)
 
 # =============================
 # 資料處理函數
@@ -289,11 +327,11 @@ class CODiSAPICrawler:
 def create_daily_summary(hourly_df):
     """將逐時資料彙總為每日資料"""
     
-    # 確保 DataTime 是 datetime 格式
-    hourly_df['DataTime'] = pd.to_datetime(hourly_df['DataTime'])
+    # 確保 DataTime 是 datetime 格式（CODiS 為 ISO 8601，指定格式走原生解析）
+    hourly_df['DataTime'] = pd.to_datetime(hourly_df['DataTime'], format='ISO8601', cache=True)
     
-    # 提取日期
-    hourly_df['Date'] = hourly_df['DataTime'].dt.date
+    # 提取日期（保持 datetime64，不轉成 Python date 物件）
+    hourly_df['Date'] = hourly_df['DataTime'].dt.normalize()
     
     # 定義不同類型的欄位
     # 1. 需要計算平均值的欄位（瞬時狀態值）
@@ -322,47 +360,75 @@ def create_daily_summary(hourly_df):
     # 建立分組欄位
     group_cols = ['Date', 'city_id', 'city_name', 'station_id']
     
-    # 建立彙總規則
-    agg_dict = {}
+    # 氣象數值只保留 1 位小數，先降為 float32 減少彙總時的記憶體搬移量
+    numeric_in_df = set(hourly_df.select_dtypes(include='number').columns)
+    float32_cols = [col for col in mean_cols + sum_cols + ['PeakGust'] if col in numeric_in_df]
+    hourly_df[float32_cols] = hourly_df[float32_cols].astype('float32')
+    if 'typhoon' in numeric_in_df:
+        hourly_df['typhoon'] = hourly_df['typhoon'].astype('int8')
+    
+    # 建立彙總規則（Polars 表達式，全部在原生程式碼中平行計算）
+    aggs = []
     
     # 平均值欄位
     for col in mean_cols:
         if col in hourly_df.columns:
-            agg_dict[col] = 'mean'
+            aggs.append(pl.col(col).mean())
     
     # 累積值欄位
     for col in sum_cols:
         if col in hourly_df.columns:
-            agg_dict[col] = 'sum'
+            aggs.append(pl.col(col).sum())
     
     # 最大值欄位
     for col in max_cols:
         if col in hourly_df.columns:
-            agg_dict[col] = 'max'
+            aggs.append(pl.col(col).max())
     
-    # 風向需要特殊處理（向量平均）
+    # 風向需要特殊處理（向量平均：sin/cos 分別平均後再以 arctan2 換回角度）
+    # 先四捨五入再取 360 的餘數，避免 359.96° 進位後輸出 360 而不是 0
     if 'WindDirection' in hourly_df.columns:
-        # 取眾數（最常出現的風向）
-        agg_dict['WindDirection'] = lambda x: x.mode()[0] if len(x.mode()) > 0 else x.mean()
+        wd_rad = pl.col('WindDirection').radians()
+        aggs.append(
+            (pl.arctan2(wd_rad.sin().mean(), wd_rad.cos().mean()).degrees().round(1) % 360)
+            .alias('WindDirection')
+        )
     
     # 颱風名稱取第一個非空值
     if 'typhoon_name' in hourly_df.columns:
-        agg_dict['typhoon_name'] = lambda x: x.dropna().iloc[0] if len(x.dropna()) > 0 else ''
-    
-    # 執行分組彙總
-    daily_df = hourly_df.groupby(group_cols).agg(agg_dict).reset_index()
+        aggs.append(pl.col('typhoon_name').drop_nulls().first().fill_null(''))
+    
+    # 執行分組彙總（先依時間排序，讓 first() 等依序取值的彙總結果固定）
+    # 分組依出現順序輸出即已依 group_cols 排好，不需再對結果排序
+    daily_df = (
+        pl.from_pandas(hourly_df)
+        .sort(group_cols + ['DataTime'])
+        .group_by(group_cols, maintain_order=True)
+        .agg(aggs)
+        .to_pandas()
+    )
     
     # 將 Date 轉回字串格式
-    daily_df['Date'] = daily_df['Date'].astype(str)
+    daily_df['Date'] = daily_df['Date'].dt.strftime('%Y-%m-%d')
     
     # 四捨五入到小數點後 1 位
-    numeric_cols = daily_df.select_dtypes(include=['float64']).columns
-    for col in numeric_cols:
-        if col not in ['typhoon']:
-            daily_df[col] = daily_df[col].round(1)
+    cols_to_round = [col for col in daily_df.select_dtypes(include=['float32', 'float64']).columns if col != 'typhoon']
+    daily_df[cols_to_round] = daily_df[cols_to_round].round(1)
     
     return daily_df
 
+def write_outputs(df, csv_name):
+    """輸出 Parquet (zstd，保留 float32/int8 型別)；WRITE_CSV 時另輸出 CSV，回傳輸出路徑"""
+    csv_path = os.path.join(OUTPUT_DIR, csv_name)
+    parquet_path = os.path.splitext(csv_path)[0] + '.parquet'
+    df.to_parquet(parquet_path, compression='zstd', engine='pyarrow', index=False)
+    paths = [parquet_path]
+    if WRITE_CSV:
+        # 相容舊流程的 CSV 維持與原本 to_csv 相同的格式（引號、浮點數寫法）
+        df.to_csv(csv_path, index=False, encoding='utf-8-sig')
+        paths.append(csv_path)
+    return paths
+
 # =============================
 # 主流程
 # =============================
@@ -387,7 +453,6 @@ def main():
     print("[步驟 3] 爬取氣象資料")
     print("-"*70)
     
-    all_data = []
     success_count = 0
     fail_count = 0
     
@@ -398,59 +463,89 @@ def main():
         dates.append(current_date)
         current_date += timedelta(days=1)
     
-    # 爬取所有測站和日期
-    total_tasks = len(STATIONS) * len(dates)
+    # 颱風資訊每個日期只計算一次，迴圈中直接查表
+    typhoon_flag = {d: 1 for d in typhoon_date_dict}
+    typhoon_name_str = {d: ', '.join(names) for d, names in typhoon_date_dict.items()}
     
-    with tqdm(total=total_tasks, desc="下載進度") as pbar:
-        for station in STATIONS:
-            for date in dates:
-                pbar.set_description(f"{station['city_name']} {date.strftime('%Y-%m-%d')}")
-                
-                # 獲取資料
-                df = crawler.fetch_weather_data(station['station_id'], date)
-                
-                if df is not None and not df.empty:
-                    # 加入城市資訊
-                    df['city_id'] = station['city_id']
-                    df['city_name'] = station['city_name']
-                    df['station_id'] = station['station_id']
-                    
-                    # 加入颱風資訊
-                    date_str = date.strftime("%Y-%m-%d")
-                    if date_str in typhoon_date_dict:
-                        df['typhoon'] = 1
-                        df['typhoon_name'] = ', '.join(typhoon_date_dict[date_str])
-                    else:
-                        df['typhoon'] = 0
-                        df['typhoon_name'] = ''
-                    
-                    all_data.append(df)
-                    success_count += 1
-                else:
-                    fail_count += 1
-                
-                pbar.update(1)
+    # 日期字串只格式化一次，迴圈中依索引取用
+    dates_iso = [d.date().isoformat() for d in dates]
+    
+    # 爬取所有測站和日期（多執行緒同時下載）
+    tasks = [(station_idx, date_idx) for station_idx in range(len(STATIONS)) for date_idx in range(len(dates))]
+    results = [None] * len(tasks)
+    
+    with tqdm(total=len(tasks), desc="下載進度") as pbar, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(fetch_weather_data_cached, crawler, STATIONS[station_idx]['station_id'], dates[date_idx]): i
+            for i, (station_idx, date_idx) in enumerate(tasks)
+        }
+        for future in as_completed(futures):
+            i = futures[future]
+            station_idx, date_idx = tasks[i]
+            pbar.set_description(f"{STATIONS[station_idx]['city_name']} {dates_iso[date_idx]}")
+            
+            # 獲取資料（城市與颱風資訊等合併後再一次加入）
+            df = future.result()
+            
+            if df is not None and not df.empty:
+                results[i] = df
+                success_count += 1
+            else:
+                fail_count += 1
+            
+            pbar.update(1)
+    
+    # 依測站、日期順序排列（與逐一下載時相同）
+    fetched = [i for i, df in enumerate(results) if df is not None]
+    all_data = [results[i] for i in fetched]
     
     # 步驟4：資料彙總與輸出
     print("\n[步驟 4] 資料彙總與輸出")
     print("-"*70)
     
     if all_data:
-        # 合併所有逐時資料
-        hourly_df = pd.concat(all_data, ignore_index=True)
+        # 合併所有逐時資料：每個欄位只串接一次，直接組成 DataFrame（避免 pd.concat 的整份複製與區塊合併）
+        # 不同測站類型的欄位可能不同，缺少的欄位補空值
+        columns = list(dict.fromkeys(col for df in all_data for col in df.columns))
+        hourly_df = pd.DataFrame({
+            col: np.concatenate([
+                df[col].to_numpy() if col in df.columns else np.full(len(df), np.nan)
+                for df in all_data
+            ])
+            for col in columns
+        }, copy=False)
+        
+        # 某天整欄皆為空值時該欄為 object，合併後一次推斷回數值型別，再將浮點欄位降為 float32
+        hourly_df = hourly_df.infer_objects()
+        float_cols = hourly_df.select_dtypes(include='float64').columns
+        hourly_df[float_cols] = hourly_df[float_cols].astype(np.float32)
+        
+        # 每一列對應的測站、日期索引，再以陣列索引一次加入城市與颱風資訊
+        # 城市、測站、颱風名稱種類很少，使用 category 型別（每列只存整數代碼）
+        lengths = [len(df) for df in all_data]
+        station_idx = np.repeat([tasks[i][0] for i in fetched], lengths)
+        date_idx = np.repeat([tasks[i][1] for i in fetched], lengths)
+        for col in ['city_id', 'city_name', 'station_id']:
+            hourly_df[col] = pd.Categorical(np.asarray([station[col] for station in STATIONS], dtype=object)[station_idx])
+        hourly_df['typhoon'] = np.array([typhoon_flag.get(d, 0) for d in dates_iso], dtype=np.int8)[date_idx]
+        hourly_df['typhoon_name'] = pd.Categorical(
+            np.array([typhoon_name_str.get(d, '') for d in dates_iso], dtype=object)[date_idx]
+        )
         
         # 資料品質統計
         total_records = len(hourly_df)
         
         print(f"📊 逐時資料品質檢查:")
-        numeric_cols = hourly_df.select_dtypes(include=['float64', 'int64']).columns
-        null_summary = []
-        for col in numeric_cols:
-            if col not in ['typhoon']:  # 排除 typhoon 欄位
-                null_count = hourly_df[col].isna().sum()
-                null_pct = (null_count / total_records) * 100
-                if null_count > 0:
-                    null_summary.append(f"   - {col}: {null_count} 筆空值 ({null_pct:.1f}%)")
+        numeric_cols = hourly_df.select_dtypes(include='number').columns
+        # 一次計算所有欄位的空值數（排除 typhoon 欄位）
+        null_counts = hourly_df[numeric_cols].drop(columns=['typhoon'], errors='ignore').isna().sum()
+        null_counts = null_counts[null_counts > 0]
+        null_pcts = null_counts / total_records * 100
+        null_summary = [
+            f"   - {col}: {null_count} 筆空值 ({null_pct:.1f}%)"
+            for col, null_count, null_pct in zip(null_counts.index, null_counts.values, null_pcts.values)
+        ]
         
         if null_summary:
             for line in null_summary[:5]:  # 只顯示前5個
@@ -461,9 +556,8 @@ def main():
             print("   ✅ 所有欄位都無空值")
         
         # 輸出逐時資料
-        hourly_output_path = os.path.join(OUTPUT_DIR, OUTPUT_CSV_HOURLY)
-        hourly_df.to_csv(hourly_output_path, index=False, encoding='utf-8-sig')
-        print(f"\n✅ 已輸出逐時資料：{hourly_output_path}")
+        hourly_output_paths = write_outputs(hourly_df, OUTPUT_CSV_HOURLY)
+        print(f"\n✅ 已輸出逐時資料：{', '.join(hourly_output_paths)}")
         print(f"   總筆數：{len(hourly_df):,} 筆（每小時一筆）")
         print(f"   時間範圍：{hourly_df['DataTime'].min()} ~ {hourly_df['DataTime'].max()}")
         
@@ -472,9 +566,8 @@ def main():
         daily_df = create_daily_summary(hourly_df)
         
         # 輸出每日資料
-        daily_output_path = os.path.join(OUTPUT_DIR, OUTPUT_CSV_DAILY)
-        daily_df.to_csv(daily_output_path, index=False, encoding='utf-8-sig')
-        print(f"✅ 已輸出每日資料：{daily_output_path}")
+        daily_output_paths = write_outputs(daily_df, OUTPUT_CSV_DAILY)
+        print(f"✅ 已輸出每日資料：{', '.join(daily_output_paths)}")
         print(f"   總筆數：{len(daily_df):,} 筆（每日彙總）")
         print(f"   日期範圍：{daily_df['Date'].min()} ~ {daily_df['Date'].max()}")
         
@@ -7,12 +7,15 @@
 2. taiwan_weather_daily.csv（每日平均、最高、最低、總雨量）
 """
 
+import numpy as np
 import pandas as pd
+import polars as pl
 from datetime import datetime
 from meteostat import Stations, Hourly
 from tqdm import tqdm
 import pytz
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 # =============================
 # 1️⃣ 參數設定
@@ -56,9 +59,25 @@ CITIES = [
 # =============================
 # 3️⃣ 找最近測站
 # =============================
-def find_nearest_station(lat, lon):
-    st = Stations().nearby(lat, lon).fetch(3)
-    return st.iloc[0] if len(st) else None
+# 台灣本島、離島（含金門、馬祖）及鄰近沿海的測站範圍
+STATION_BOUNDS = ((27.0, 118.0), (21.5, 122.5))
+
+
+def find_nearest_stations(cities):
+    """一次取得範圍內所有測站，以 haversine 距離向量化找出每個城市最近的測站"""
+    st = Stations().bounds(*STATION_BOUNDS).fetch()
+    if st.empty:
+        return [None] * len(cities)
+
+    lat1 = np.radians([c["lat"] for c in cities])[:, None]
+    lon1 = np.radians([c["lon"] for c in cities])[:, None]
+    lat2 = np.radians(st["latitude"].to_numpy())[None, :]
+    lon2 = np.radians(st["longitude"].to_numpy())[None, :]
+
+    # haversine 的 a 值與距離單調相關，直接取最小值即可
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    nearest = a.argmin(axis=1)
+    return [st.iloc[i] for i in nearest]
 
 
 # =============================
@@ -83,8 +102,7 @@ def fetch_hourly_by_station(station_id, start, end):
 # 5️⃣ 主流程
 # =============================
 city_station = []
-for c in CITIES:
-    st = find_nearest_station(c["lat"], c["lon"])
+for c, st in zip(CITIES, find_nearest_stations(CITIES)):
     if st is None:
         print(f"[WARN] 找不到測站: {c['city_name']}")
         continue
@@ -102,69 +120,98 @@ print("\n✅ 城市對應測站：")
 print(city_station_df[["city_id", "city_name", "station_id", "station_name"]])
 
 # =============================
-# 6️⃣ 下載資料
-# =============================
-all_list = []
-for row in tqdm(city_station, desc="Downloading hourly weather"):
-    sid = row["station_id"]
-    df = fetch_hourly_by_station(sid, START, END)
-    if df.empty:
-        continue
-
-    out = pd.DataFrame({
-        "ObsDate": df["datetime"].dt.date.astype(str),
-        "city_id": row["city_id"],
-        "ObsTime": df["datetime"].dt.strftime("%H:%M"),
-        "StnPres": df.get("pres"),
-        "Temperature": df.get("temp"),
-        "RH": df.get("rhum"),
-        "WS": df.get("wspd"),
-        "Precp": df.get("prcp"),
-    })
-    out["typhoon"] = 0
-    out["typhoon_name"] = ""
-    all_list.append(out)
-
-# 合併全部城市
-result = pd.concat(all_list, ignore_index=True) if all_list else pd.DataFrame()
-
-# =============================
-# 7️⃣ 匯入颱風表（選擇性）
+# 6️⃣ 匯入颱風表（選擇性）
 # =============================
 typhoon_path = Path(TYPHOON_CSV)
-if typhoon_path.exists() and not result.empty:
+ty = None
+if typhoon_path.exists():
     ty = pd.read_csv(typhoon_path, dtype={"typhoon": int, "typhoon_name": str})
     ty["date"] = pd.to_datetime(ty["date"]).dt.date.astype(str)
-    result = result.merge(
-        ty.rename(columns={"date": "ObsDate"}),
-        on="ObsDate", how="left", suffixes=("", "_y")
-    )
-    result["typhoon"] = result["typhoon_y"].fillna(result["typhoon"]).fillna(0).astype(int)
-    result["typhoon_name"] = result["typhoon_name_y"].fillna(result["typhoon_name"]).fillna("")
-    result.drop(columns=[c for c in result.columns if c.endswith("_y")], inplace=True)
+    ty = ty.rename(columns={"date": "ObsDate"})
+
+
+def attach_typhoon(out):
+    if ty is None:
+        return out
+    out = out.merge(ty, on="ObsDate", how="left", suffixes=("", "_y"))
+    out["typhoon"] = out["typhoon_y"].fillna(out["typhoon"]).fillna(0).astype(int)
+    out["typhoon_name"] = out["typhoon_name_y"].fillna(out["typhoon_name"]).fillna("")
+    out.drop(columns=[c for c in out.columns if c.endswith("_y")], inplace=True)
+    return out
+
 
 # =============================
-# 8️⃣ 輸出逐時資料
+# 7️⃣ 下載資料並逐站輸出逐時資料（不合併成單一大表）
 # =============================
-if not result.empty:
-    result.to_csv(OUT_HOURLY, index=False, encoding="utf-8-sig")
-    print(f"\n✅ 已輸出逐時氣象資料：{OUT_HOURLY}（共 {len(result):,} 筆）")
+MAX_WORKERS = 8  # 同時下載的測站數
+
+# 一天 1440 個 "HH:MM" 字串，依分鐘索引取用，不必逐列 strftime
+TIME_LUT = np.array([f"{h:02d}:{m:02d}" for h in range(24) for m in range(60)])
+
+
+def fetch_city_hourly(row):
+    return row, fetch_hourly_by_station(row["station_id"], START, END)
+
+
+total_rows = 0
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    for row, df in tqdm(executor.map(fetch_city_hourly, city_station),
+                        total=len(city_station), desc="Downloading hourly weather"):
+        if df.empty:
+            continue
+
+        # 以台北當地時間（去除時區資訊後）計算日期與時間
+        local_dt = df["datetime"].dt.tz_localize(None)
+        obs_date = np.datetime_as_string(local_dt.to_numpy().astype("datetime64[D]"), unit="D")
+        obs_time = TIME_LUT[local_dt.dt.hour.to_numpy() * 60 + local_dt.dt.minute.to_numpy()]
+
+        out = pd.DataFrame({
+            "ObsDate": obs_date,
+            "city_id": row["city_id"],
+            "ObsTime": obs_time,
+            "StnPres": df.get("pres"),
+            "Temperature": df.get("temp"),
+            "RH": df.get("rhum"),
+            "WS": df.get("wspd"),
+            "Precp": df.get("prcp"),
+        })
+        out["typhoon"] = 0
+        out["typhoon_name"] = ""
+        out = attach_typhoon(out)
+
+        # 第一個測站寫入 BOM 與標頭，之後直接附加
+        first = total_rows == 0
+        out.to_csv(OUT_HOURLY, mode="w" if first else "a", header=first, index=False,
+                   encoding="utf-8-sig" if first else "utf-8")
+        total_rows += len(out)
+
+if total_rows:
+    print(f"\n✅ 已輸出逐時氣象資料：{OUT_HOURLY}（共 {total_rows:,} 筆）")
 else:
     print("\n⚠️ 沒有抓到任何資料，請檢查測站或時間設定")
 
 # =============================
-# 9️⃣ 產出每日聚合資料
-# =============================
-if not result.empty:
-    daily = result.copy()
-    daily["ObsDate"] = pd.to_datetime(daily["ObsDate"])
-    daily = daily.groupby(["city_id", "ObsDate"], as_index=False).agg({
-        "Temperature": ["mean", "max", "min"],
-        "RH": "mean",
-        "WS": "mean",
-        "Precp": "sum"
-    })
-    daily.columns = ["city_id", "ObsDate", "Temp_Avg", "Temp_Max", "Temp_Min", "RH_Avg", "WS_Avg", "Precp_Sum"]
-    daily["ObsDate"] = daily["ObsDate"].dt.date.astype(str)
-    daily.to_csv(OUT_DAILY, index=False, encoding="utf-8-sig")
-    print(f"✅ 已輸出每日氣象彙總：{OUT_DAILY}（共 {len(daily):,} 筆）")
+# 8️⃣ 產出每日聚合資料
+# =============================
+HOURLY_NUMERIC_SCHEMA = {col: pl.Float64 for col in ["StnPres", "Temperature", "RH", "WS", "Precp"]}
+
+if total_rows:
+    # 直接串流讀取逐時 CSV 彙總並寫出，不需將全部資料載入記憶體
+    # ObsDate 已是 YYYY-MM-DD 字串，可直接分組
+    # 數值欄位明確指定型別：開頭整段缺值時 Polars 會把欄位推斷成字串
+    (
+        pl.scan_csv(OUT_HOURLY, schema_overrides=HOURLY_NUMERIC_SCHEMA)
+        .group_by(["city_id", "ObsDate"])
+        .agg([
+            pl.col("Temperature").mean().alias("Temp_Avg"),
+            pl.col("Temperature").max().alias("Temp_Max"),
+            pl.col("Temperature").min().alias("Temp_Min"),
+            pl.col("RH").mean().alias("RH_Avg"),
+            pl.col("WS").mean().alias("WS_Avg"),
+            pl.col("Precp").sum().alias("Precp_Sum"),
+        ])
+        .sort(["city_id", "ObsDate"])
+        .sink_csv(OUT_DAILY, include_bom=True)
+    )
+    daily_rows = pl.scan_csv(OUT_DAILY).select(pl.len()).collect().item()
+    print(f"✅ 已輸出每日氣象彙總：{OUT_DAILY}（共 {daily_rows:,} 筆）")